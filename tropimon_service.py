@@ -2,11 +2,34 @@ import os
 import sys
 import json
 import hashlib
-
-from fastapi import FastAPI, Query, Request
-from fastapi.responses import HTMLResponse
+import sqlite3
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from collections import deque
+from itertools import islice
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # stdlib fallback, also accepts bytes
+    json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from fastapi_cache import FastAPICache
+from starlette.routing import Match
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 from sqlalchemy import (
     create_engine,
@@ -16,34 +39,72 @@ from sqlalchemy import (
     Boolean,
     ForeignKey,
     BigInteger,
+    Index,
+    event,
     func,
+    select,
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.schema import CreateIndex, CreateTable, DropTable
+from sqlalchemy.orm import declarative_base, relationship
 
 # ---------- CONFIG ----------
 
 LOG_FOLDER = "/app/logs"
+OLD_LOG_FILE = "pokemon_logs.json"
+CATCH_LOG_FILE = "POKEMON_CATCH.json"
 DATABASE_URL = "sqlite:///./tropimon_stats.db"
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./tropimon_stats.db"
+
+# Data only changes on CLI reload, which flushes the cache through this endpoint
+API_CACHE_EXPIRE = 60
+CACHE_FLUSH_URL = os.environ.get("TROPIMON_CACHE_FLUSH_URL", "http://127.0.0.1:8000/admin/flush-cache")
 
 # Legendary species
-LEGENDARIES = {
+LEGENDARIES = frozenset({
     "cobblemon:articuno", "cobblemon:zaptos", "cobblemon:moltres",
     "cobblemon:suicune", "cobblemon:entei", "cobblemon:raikou",
     "cobblemon:regigigas", "cobblemon:rayquaza",
-}
+})
 
 # Mythical species
-MYTHICALS = {
+MYTHICALS = frozenset({
     "cobblemon:mew", "cobblemon:celebi", "cobblemon:jirachi",
     "cobblemon:manaphy", "cobblemon:shaymin", "cobblemon:arceus",
     "cobblemon:victini", "cobblemon:marshadow",
-}
+})
 
 # ---------- DB SETUP ----------
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    query_cache_size=1200,
+)
+
+# HTTP side: async engine so SQL round-trips don't park a threadpool worker.
+# The sync engine above stays for init_db() and the CLI load.
+async_engine = create_async_engine(ASYNC_DATABASE_URL, query_cache_size=1200, pool_size=8)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+# WAL lets readers run alongside the loader; mmap serves pages from the OS page cache
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA cache_size=-100000",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in CONNECTION_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+event.listen(engine, "connect", set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
 
 
 class Player(Base):
@@ -51,6 +112,7 @@ class Player(Base):
 
     id = Column(String, primary_key=True, index=True)
     last_seen_timestamp = Column(BigInteger, nullable=True)
+    anon_label = Column(String, nullable=True)
 
     captures = relationship("Capture", back_populates="player")
 
@@ -65,30 +127,76 @@ class Species(Base):
     captures = relationship("Capture", back_populates="species")
 
 
+class LoadManifest(Base):
+    __tablename__ = "load_manifest"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    path = Column(String, unique=True, nullable=False)
+    mtime_ns = Column(BigInteger, nullable=False)
+    size = Column(BigInteger, nullable=False)
+
+
 class Capture(Base):
     __tablename__ = "captures"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    player_id = Column(String, ForeignKey("players.id"), index=True)
-    species_id = Column(String, ForeignKey("species.id"), index=True)
+    player_id = Column(String, ForeignKey("players.id"))
+    species_id = Column(String, ForeignKey("species.id"))
+    # Log file the row came from, so a changed file only replaces its own rows
+    source_id = Column(Integer, ForeignKey("load_manifest.id"))
     timestamp = Column(BigInteger, nullable=False)
     is_shiny = Column(Boolean, default=False)
+    # Copied from Species at load time so rollups never join species
+    species_is_legendary = Column(Boolean, default=False)
+    species_is_mythical = Column(Boolean, default=False)
+
+    # Covering indexes: group-bys on captures are answered from the index alone
+    __table_args__ = (
+        Index("ix_cap_player_shiny", "player_id", "is_shiny", "species_is_legendary", "species_is_mythical"),
+        Index("ix_cap_species_player", "species_id", "player_id"),
+        Index("ix_cap_source", "source_id"),
+    )
 
     player = relationship("Player", back_populates="captures")
     species = relationship("Species", back_populates="captures")
 
 
-def init_db():
-    Base.metadata.create_all(bind=engine)
+class Meta(Base):
+    __tablename__ = "meta"
 
+    k = Column(String, primary_key=True)
+    v = Column(String, nullable=True)
 
-def get_session():
-    init_db()
-    return SessionLocal()
+
+# Rollups rebuilt at the end of every load, read by the API instead of captures
+
+class PlayerStats(Base):
+    __tablename__ = "player_stats"
+
+    player_id = Column(String, primary_key=True)
+    captures = Column(Integer, nullable=False, index=True)
+    shiny = Column(Integer, nullable=False, index=True)
+    legendaries = Column(Integer, nullable=False, index=True)
+    mythicals = Column(Integer, nullable=False, index=True)
+
+
+class SpeciesStats(Base):
+    __tablename__ = "species_stats"
+
+    species_id = Column(String, primary_key=True)
+    captures = Column(Integer, nullable=False, index=True)
+    shiny = Column(Integer, nullable=False, index=True)
+    is_legendary = Column(Boolean, default=False)
+    is_mythical = Column(Boolean, default=False)
+
+
+def init_db():
+    Base.metadata.create_all(bind=engine)
 
 
 # ---------- UTIL: NORMALISATION species_id ----------
 
+@lru_cache(maxsize=4096)
 def normalize_species_id(species_id: str) -> str:
     """
     Accept:
@@ -96,227 +204,545 @@ def normalize_species_id(species_id: str) -> str:
       - Geodude
       - CObbLEmon:geodude
     Converts everything → cobblemon:geodude
+    Cached on the raw input (few distinct species), result is interned.
     """
     species_id = species_id.strip().lower()
     if not species_id.startswith("cobblemon:"):
         species_id = "cobblemon:" + species_id
-    return species_id
+    return sys.intern(species_id)
 
 
 # ---------- ANONYMIZER ----------
 
+# Computed once per player at load time and stored in players.anon_label
 def anonymize_uuid(uuid: str) -> str:
     h = hashlib.sha256(uuid.encode()).hexdigest()[:4].upper()
     return f"Player #{h}"
 
 
-def reset_database(session):
-    session.query(Capture).delete()
-    session.query(Species).delete()
-    session.query(Player).delete()
-    session.commit()
+# ---------- UTIL: JSON STREAMING ----------
 
+def iter_json_items(f):
+    """Yield the elements of a top-level JSON array, one at a time."""
+    if ijson is None:
+        yield from json_loads(f.read())
+        return
+    yield from ijson.items(f, "item", use_float=True)
 
-# ---------- OLD FORMAT LOADER ----------
 
-def load_old_json_file(path: str, session, player_cache, species_cache):
-    if not os.path.isfile(path):
-        print("No old-format pokemon_logs.json found.")
+def iter_json_kvitems(f):
+    """Yield (key, value) pairs of a top-level JSON object, one at a time."""
+    if ijson is None:
+        yield from json_loads(f.read()).items()
         return
+    yield from ijson.kvitems(f, "", use_float=True)
 
-    print(f"Loading old-format file: {path}")
 
+def compile_ddl(element) -> str:
+    return str(element.compile(dialect=engine.dialect))
+
+
+def reset_database(cur):
+    """
+    Drop and recreate every table, so a database built by an older version
+    picks up new columns and loses indexes that no longer exist in the models.
+    """
+    tables = Base.metadata.sorted_tables
+    for table in reversed(tables):
+        cur.execute(compile_ddl(DropTable(table, if_exists=True)))
+
+    for table in tables:
+        cur.execute(compile_ddl(CreateTable(table)))
+        # Per-row index maintenance is a large part of the insert cost:
+        # the capture indices are only built by bulk_load() once the rows are in.
+        if table is Capture.__table__:
+            continue
+        for index in table.indexes:
+            cur.execute(compile_ddl(CreateIndex(index)))
+
+
+# ---------- BULK LOAD (raw sqlite3) ----------
+
+CAPTURE_BATCH_SIZE = 50_000
+
+# Files parsed ahead of the inserting loop, per worker process
+PARSE_WINDOW = 2
+
+# The CLI load is an offline rebuild: trade durability for fsync-free inserts
+BULK_LOAD_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=OFF;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-200000;
+"""
+
+# Players / species may already exist when only some files are reloaded
+INSERT_PLAYER_SQL = "INSERT OR IGNORE INTO players (id, last_seen_timestamp, anon_label) VALUES (?, ?, ?)"
+INSERT_SPECIES_SQL = "INSERT OR IGNORE INTO species (id, is_legendary, is_mythical) VALUES (?, ?, ?)"
+INSERT_CAPTURE_SQL = (
+    "INSERT INTO captures "
+    "(source_id, player_id, species_id, timestamp, is_shiny, species_is_legendary, species_is_mythical) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+INSERT_META_SQL = "INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)"
+
+SELECT_MANIFEST_SQL = "SELECT id, path, mtime_ns, size FROM load_manifest"
+INSERT_MANIFEST_SQL = "INSERT INTO load_manifest (path, mtime_ns, size) VALUES (?, ?, ?)"
+UPDATE_MANIFEST_SQL = "UPDATE load_manifest SET mtime_ns = ?, size = ? WHERE id = ?"
+DELETE_MANIFEST_SQL = "DELETE FROM load_manifest WHERE id = ?"
+DELETE_SOURCE_CAPTURES_SQL = "DELETE FROM captures WHERE source_id = ?"
+
+ROLLUP_SQL = (
+    "DELETE FROM player_stats",
+    "DELETE FROM species_stats",
+    """
+    INSERT INTO player_stats (player_id, captures, shiny, legendaries, mythicals)
+    SELECT player_id, COUNT(*), SUM(is_shiny), SUM(species_is_legendary), SUM(species_is_mythical)
+    FROM captures
+    GROUP BY player_id
+    """,
+    """
+    INSERT INTO species_stats (species_id, captures, shiny, is_legendary, is_mythical)
+    SELECT species_id, COUNT(*), SUM(is_shiny), MAX(species_is_legendary), MAX(species_is_mythical)
+    FROM captures
+    GROUP BY species_id
+    """,
+)
+
+# After a partial reload: drop rows no capture points to any more, refresh last_seen
+PRUNE_SQL = (
+    "DELETE FROM players WHERE id NOT IN (SELECT player_id FROM player_stats)",
+    "DELETE FROM species WHERE id NOT IN (SELECT species_id FROM species_stats)",
+    """
+    UPDATE players SET last_seen_timestamp = seen.ts
+    FROM (SELECT player_id, MAX(timestamp) AS ts FROM captures GROUP BY player_id) AS seen
+    WHERE seen.player_id = players.id
+    """,
+)
+
+
+def import_source(cur, manifest, path, stat, captures):
+    """
+    Replace the captures of one log file and record its new stat.
+    captures is an iterable of
+    (player_id, species_id, timestamp, is_shiny, species_is_legendary, species_is_mythical)
+    and may raise mid-stream: everything is then rolled back to the savepoint, so
+    the file keeps its previous rows and manifest stat and the next load retries it.
+    """
+    cur.execute("SAVEPOINT import_source")
     try:
-        with open(path, "r", encoding="utf8") as f:
-            data = json.load(f)
+        if path in manifest:
+            source_id = manifest[path][0]
+            cur.execute(DELETE_SOURCE_CAPTURES_SQL, (source_id,))
+            cur.execute(UPDATE_MANIFEST_SQL, (*stat, source_id))
+        else:
+            cur.execute(INSERT_MANIFEST_SQL, (path, *stat))
+            source_id = cur.lastrowid
+
+        rows = ((source_id, *row) for row in captures)
+        while batch := list(islice(rows, CAPTURE_BATCH_SIZE)):
+            cur.executemany(INSERT_CAPTURE_SQL, batch)
+    except sqlite3.Error:
+        raise
     except Exception as e:
-        print("Error reading old file:", e)
-        return
+        print(f"Error reading {path}: {e}")
+        cur.execute("ROLLBACK TO import_source")
+        return False
+    finally:
+        cur.execute("RELEASE import_source")
+    return True
 
-    for player_uuid, captures in data.items():
 
-        for entry in captures:
-            poke = entry.get("pokemon", {})
-            raw_species = poke.get("Species")
-            species_id = normalize_species_id(raw_species)
-            ts = entry.get("captureTimestamp", 0)
-            is_shiny = bool(poke.get("Shiny", False))
+def bulk_load(cur, full: bool, player_cache, species_cache):
+    """
+    Finish one load inside its transaction, once every file went through import_source():
+    players / species, capture indices after a full reset, rollups and the load generation.
+    """
+    cur.executemany(
+        INSERT_PLAYER_SQL,
+        ((p["id"], p["last_seen_timestamp"], p["anon_label"]) for p in player_cache.values()),
+    )
+    cur.executemany(
+        INSERT_SPECIES_SQL,
+        ((sp["id"], sp["is_legendary"], sp["is_mythical"]) for sp in species_cache.values()),
+    )
 
-            if not species_id or not player_uuid:
-                continue
+    if full:
+        for index in Capture.__table__.indexes:
+            cur.execute(compile_ddl(CreateIndex(index)))
 
-            # PLAYER
-            if player_uuid not in player_cache:
-                player = Player(id=player_uuid, last_seen_timestamp=ts)
-                session.add(player)
-                player_cache[player_uuid] = player
-            else:
-                player = player_cache[player_uuid]
-                if ts > (player.last_seen_timestamp or 0):
-                    player.last_seen_timestamp = ts
-
-            # SPECIES
-            if species_id not in species_cache:
-                species = Species(
-                    id=species_id,
-                    is_legendary=species_id in LEGENDARIES,
-                    is_mythical=species_id in MYTHICALS
-                )
-                session.add(species)
-                species_cache[species_id] = species
-            else:
-                species = species_cache[species_id]
-
-            cap = Capture(
-                player=player,
-                species=species,
-                timestamp=ts,
-                is_shiny=is_shiny
-            )
-            session.add(cap)
+    print("Building rollups...")
+    for sql in ROLLUP_SQL:
+        cur.execute(sql)
 
-    print("Old-format logs imported successfully.")
+    if not full:
+        for sql in PRUNE_SQL:
+            cur.execute(sql)
 
+    # New generation → new ETag for every /api/* response
+    cur.execute(INSERT_META_SQL, ("load_generation", str(int(time.time() * 1000))))
 
-# ---------- DATA LOADER NEW FORMAT ----------
 
-def update_database_from_logs(log_folder: str = LOG_FOLDER):
+def record_capture(player_cache, species_cache, player_uuid, species_id, ts, is_shiny):
+    """
+    Register the player / species of one capture and return its row for import_source().
+    player_cache / species_cache hold one row dict per primary key.
+    """
+    # PLAYER
+    player = player_cache.get(player_uuid)
+    if player is None:
+        player_cache[player_uuid] = {
+            "id": player_uuid,
+            "last_seen_timestamp": ts,
+            "anon_label": anonymize_uuid(player_uuid),
+        }
+    elif ts > (player["last_seen_timestamp"] or 0):
+        player["last_seen_timestamp"] = ts
+
+    # SPECIES (legendary / mythical flags only computed on first sight)
+    species = species_cache.get(species_id)
+    if species is None:
+        species = species_cache[species_id] = {
+            "id": species_id,
+            "is_legendary": species_id in LEGENDARIES,
+            "is_mythical": species_id in MYTHICALS,
+        }
+
+    return (player_uuid, species_id, ts, is_shiny, species["is_legendary"], species["is_mythical"])
 
-    init_db()
-    session = SessionLocal()
 
-    print("Resetting database...")
-    reset_database(session)
+# ---------- OLD FORMAT LOADER ----------
+
+def load_old_json_file(path: str, player_cache, species_cache):
+    """
+    Stream capture rows out of the old uuid → [captures] file.
+    Read / parse errors propagate to the consumer (see import_source).
+    """
+    print(f"Loading old-format file: {path}")
+
+    with open(path, "rb") as f:
+        for player_uuid, entries in iter_json_kvitems(f):
+
+            for entry in entries:
+                poke = entry.get("pokemon", {})
+                raw_species = poke.get("Species")
+                species_id = normalize_species_id(raw_species)
+                ts = entry.get("captureTimestamp", 0)
+                is_shiny = bool(poke.get("Shiny", False))
+
+                if not species_id or not player_uuid:
+                    continue
 
+                yield record_capture(player_cache, species_cache, player_uuid, species_id, ts, is_shiny)
+
+
+# ---------- DATA LOADER NEW FORMAT ----------
+
+def parse_catch_file(json_file_path: str):
+    """
+    Parse one <player>/POKEMON_CATCH.json without touching the database.
+    Runs in a worker process, returns (player_rows, species_rows, capture_rows),
+    or None when the file could not be read completely.
+    """
     player_cache = {}
     species_cache = {}
+    captures = []
 
-    # Load OLD
-    old_file = os.path.join(log_folder, "pokemon_logs.json")
-    load_old_json_file(old_file, session, player_cache, species_cache)
+    print(f"Processing {json_file_path}...")
 
-    # Load NEW
-    for folder_name in os.listdir(log_folder):
-        folder_path = os.path.join(log_folder, folder_name)
+    try:
+        with open(json_file_path, "rb") as f:
+            for entry in iter_json_items(f):
+                player_uuid = entry.get("player")
+                datas = entry.get("datas", {})
 
-        if not os.path.isdir(folder_path):
-            continue
+                raw_species = datas.get("Species", "")
+                species_id = normalize_species_id(raw_species)
 
-        json_file_path = os.path.join(folder_path, "POKEMON_CATCH.json")
-        if not os.path.isfile(json_file_path):
-            continue
+                ts = entry.get("timestamp", 0)
+                is_shiny = bool(datas.get("Shiny", False))
+
+                if not player_uuid or not species_id:
+                    continue
 
-        print(f"Processing {json_file_path}...")
+                captures.append(
+                    record_capture(player_cache, species_cache, player_uuid, species_id, ts, is_shiny)
+                )
+    except Exception as e:
+        print(f"Error reading {json_file_path}: {e}")
+        return None
+
+    return list(player_cache.values()), list(species_cache.values()), captures
+
+
+def merge_rows(player_cache, species_cache, player_rows, species_rows):
+    for player in player_rows:
+        cached = player_cache.get(player["id"])
+        if cached is None:
+            player_cache[player["id"]] = player
+        elif player["last_seen_timestamp"] > (cached["last_seen_timestamp"] or 0):
+            cached["last_seen_timestamp"] = player["last_seen_timestamp"]
+
+    for species in species_rows:
+        species_cache.setdefault(species["id"], species)
+
+
+def load_new_log_files(paths):
+    """
+    Parse the given POKEMON_CATCH.json files in parallel, yield (path, parse_catch_file result)
+    in order. At most PARSE_WINDOW × cpu_count files are submitted ahead of the consumer,
+    so parsed-but-not-inserted files never pile up in memory.
+    """
+    workers = os.cpu_count() or 1
+    pending = deque()
 
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path in paths:
+            pending.append((path, executor.submit(parse_catch_file, path)))
+            if len(pending) >= PARSE_WINDOW * workers:
+                path, future = pending.popleft()
+                yield path, future.result()
+
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+# ---------- LOAD MANIFEST ----------
+
+def scan_log_sources(log_folder: str):
+    """Return {path: (mtime_ns, size)} for the old file and every POKEMON_CATCH.json."""
+    paths = [os.path.join(log_folder, OLD_LOG_FILE)]
+
+    # DirEntry carries the file type from the directory read: no stat per folder
+    with os.scandir(log_folder) as it:
+        paths += [os.path.join(entry.path, CATCH_LOG_FILE) for entry in it if entry.is_dir()]
+
+    sources = {}
+    for path in paths:
         try:
-            with open(json_file_path, "r", encoding="utf-8") as f:
-                logs = json.load(f)
-        except Exception as e:
-            print(f"Error reading {json_file_path}: {e}")
+            st = os.stat(path)
+        except FileNotFoundError:
             continue
+        sources[path] = (st.st_mtime_ns, st.st_size)
+    return sources
 
-        for entry in logs:
-            player_uuid = entry.get("player")
-            datas = entry.get("datas", {})
 
-            raw_species = datas.get("Species", "")
-            species_id = normalize_species_id(raw_species)
+def notify_cache_flush():
+    try:
+        request = urllib.request.Request(CACHE_FLUSH_URL, method="POST")
+        urllib.request.urlopen(request, timeout=5).close()
+        print("API cache flushed.")
+    except OSError as e:
+        print(f"Could not flush API cache ({e}), it expires within {API_CACHE_EXPIRE}s.")
 
-            ts = entry.get("timestamp", 0)
-            is_shiny = bool(datas.get("Shiny", False))
 
-            if not player_uuid or not species_id:
+def update_database_from_logs(log_folder: str = LOG_FOLDER, full: bool = False):
+    """
+    Import the logs, re-parsing only files whose mtime / size changed since the
+    last load (everything when full or on first load). Returns False when
+    nothing changed.
+    """
+    init_db()
+
+    sources = scan_log_sources(log_folder)
+
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.executescript(BULK_LOAD_PRAGMAS)
+
+        manifest = {
+            path: (source_id, (mtime_ns, size))
+            for source_id, path, mtime_ns, size in cur.execute(SELECT_MANIFEST_SQL).fetchall()
+        }
+        full = full or not manifest
+        if full:
+            manifest = {}
+
+        changed = [path for path, stat in sources.items() if path not in manifest or manifest[path][1] != stat]
+        removed = [source_id for path, (source_id, _) in manifest.items() if path not in sources]
+
+        if not full and not changed and not removed:
+            print("Logs unchanged since last load, nothing to do.")
+            return False
+
+        if not full:
+            print(f"Reloading {len(changed)} changed and {len(removed)} removed log files...")
+
+        # Everything below is one transaction: readers never see a half-built dataset
+        cur.execute("BEGIN")
+        if full:
+            print("Resetting database...")
+            reset_database(cur)
+
+        for source_id in removed:
+            cur.execute(DELETE_SOURCE_CAPTURES_SQL, (source_id,))
+            cur.execute(DELETE_MANIFEST_SQL, (source_id,))
+
+        player_cache = {}
+        species_cache = {}
+
+        old_file = os.path.join(log_folder, OLD_LOG_FILE)
+        if old_file not in sources:
+            print("No old-format pokemon_logs.json found.")
+        elif old_file in changed:
+            # Own caches: a file that fails halfway must not leave its players / species behind
+            old_players = {}
+            old_species = {}
+            old_captures = load_old_json_file(old_file, old_players, old_species)
+            if import_source(cur, manifest, old_file, sources[old_file], old_captures):
+                merge_rows(player_cache, species_cache, old_players.values(), old_species.values())
+                print("Old-format logs imported successfully.")
+
+        # Memory: the old file streams entry by entry, catch files are held whole
+        # but only for the bounded window of load_new_log_files()
+        catch_files = [path for path in changed if path != old_file]
+        for path, parsed in load_new_log_files(catch_files):
+            if parsed is None:
                 continue
+            player_rows, species_rows, capture_rows = parsed
+            if import_source(cur, manifest, path, sources[path], capture_rows):
+                merge_rows(player_cache, species_cache, player_rows, species_rows)
 
-            # Player
-            if player_uuid not in player_cache:
-                player = Player(id=player_uuid, last_seen_timestamp=ts)
-                session.add(player)
-                player_cache[player_uuid] = player
-            else:
-                player = player_cache[player_uuid]
-                if ts > (player.last_seen_timestamp or 0):
-                    player.last_seen_timestamp = ts
-
-            # Species
-            if species_id not in species_cache:
-                species = Species(
-                    id=species_id,
-                    is_legendary=species_id in LEGENDARIES,
-                    is_mythical=species_id in MYTHICALS,
-                )
-                session.add(species)
-                species_cache[species_id] = species
-            else:
-                species = species_cache[species_id]
-
-            capture = Capture(
-                player=player,
-                species=species,
-                timestamp=ts,
-                is_shiny=is_shiny,
-            )
-            session.add(capture)
+        bulk_load(cur, full, player_cache, species_cache)
+        raw.commit()
+
+        # Fresh statistics so the planner picks the covering indexes
+        cur.execute("ANALYZE")
+        cur.execute("PRAGMA optimize")
+    finally:
+        raw.close()
 
-    session.commit()
-    session.close()
     print("Database update complete.")
+    return True
 
 
 # ---------- FASTAPI SETUP ----------
 
-app = FastAPI(title="Tropimon Stats – Anonymous")
+app = FastAPI(title="Tropimon Stats – Anonymous", default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader("templates"),
+        # Compiled templates shared by every worker process. No explicit directory:
+        # Jinja then uses a per-user 0700 temp dir and checks its owner.
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False,
+        cache_size=400,
+        autoescape=True,
+    )
+)
+
+
+async def load_etag():
+    async with AsyncSessionLocal() as s:
+        generation = (
+            await s.execute(select(Meta.v).where(Meta.k == "load_generation"))
+        ).scalar()
+
+    etag = f'"{generation}"' if generation else None
+    if etag != getattr(app.state, "etag", None):
+        # Cached bodies belong to the previous generation: never pair them with the new ETag
+        await FastAPICache.clear()
+
+    app.state.etag = etag
+    app.state.etag_checked_at = time.monotonic()
+
+
+def matches_route(scope) -> bool:
+    return any(route.matches(scope)[0] == Match.FULL for route in app.router.routes)
+
+
+@app.on_event("startup")
+async def startup():
+    # Schema check once per process, not per request
+    init_db()
+    FastAPICache.init(InMemoryBackend(), prefix="tropimon")
+    await load_etag()
+
+
+@app.middleware("http")
+async def api_etag(request: Request, call_next):
+    if request.method != "GET" or not request.url.path.startswith("/api/"):
+        return await call_next(request)
+
+    # Re-read at cache expiry too, in case the loader could not reach /admin/flush-cache
+    if time.monotonic() - app.state.etag_checked_at > API_CACHE_EXPIRE:
+        await load_etag()
+
+    etag = app.state.etag
+    if etag is None:
+        return await call_next(request)
+
+    if request.headers.get("if-none-match") == etag and matches_route(request.scope):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers["ETag"] = etag
+    return response
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await async_engine.dispose()
 
 
 # ---------- API HELPERS ----------
 
-def api_summary(session):
+async def api_summary(session):
+    # One pass over the per-player rollup instead of four scans of captures
+    row = (
+        await session.execute(
+            select(
+                func.coalesce(func.sum(PlayerStats.captures), 0),
+                func.coalesce(func.sum(PlayerStats.shiny), 0),
+                func.coalesce(func.sum(PlayerStats.legendaries), 0),
+                func.coalesce(func.sum(PlayerStats.mythicals), 0),
+            )
+        )
+    ).one()
+
     return {
-        "total_captures": session.query(func.count(Capture.id)).scalar() or 0,
-        "total_shiny": session.query(func.count(Capture.id)).filter(Capture.is_shiny == True).scalar() or 0,
-        "total_legendaries": session.query(func.count(Capture.id))
-            .join(Species, Capture.species_id == Species.id)
-            .filter(Species.is_legendary == True)
-            .scalar() or 0,
-        "total_mythicals": session.query(func.count(Capture.id))
-            .join(Species, Capture.species_id == Species.id)
-            .filter(Species.is_mythical == True)
-            .scalar() or 0,
+        "total_captures": row[0],
+        "total_shiny": row[1],
+        "total_legendaries": row[2],
+        "total_mythicals": row[3],
     }
 
 
-def api_species_detail(session, species_id: str):
+async def api_species_detail(session, species_id: str):
 
     species_id = normalize_species_id(species_id)
 
-    total = (
-        session.query(func.count(Capture.id))
-        .filter(Capture.species_id == species_id)
-        .scalar()
-        or 0
-    )
-
-    shiny = (
-        session.query(func.count(Capture.id))
-        .filter(Capture.species_id == species_id, Capture.is_shiny == True)
-        .scalar()
-        or 0
-    )
+    stats = (
+        await session.execute(
+            select(SpeciesStats.captures, SpeciesStats.shiny)
+            .where(SpeciesStats.species_id == species_id)
+        )
+    ).first()
+    total, shiny = stats or (0, 0)
 
-    q = (
-        session.query(
+    top = (
+        select(
             Capture.player_id,
-            func.count(Capture.id),
+            func.count(Capture.id).label("count"),
         )
-        .filter(Capture.species_id == species_id)
+        .where(Capture.species_id == species_id)
         .group_by(Capture.player_id)
         .order_by(func.count(Capture.id).desc())
         .limit(10)
+        .subquery()
+    )
+    q = (
+        select(Player.anon_label, top.c.count)
+        .join(Player, Player.id == top.c.player_id)
+        .order_by(top.c.count.desc())
     )
 
-    rows = [{"player": anonymize_uuid(pid), "count": c} for pid, c in q]
+    rows = [{"player": label, "count": c} for label, c in (await session.execute(q)).all()]
 
     return {
         "species": species_id,
@@ -326,92 +752,99 @@ def api_species_detail(session, species_id: str):
     }
 
 
+async def api_top_players(session, count_column, limit: int):
+    q = (
+        select(Player.anon_label, count_column)
+        .join(Player, Player.id == PlayerStats.player_id)
+        .where(count_column > 0)
+        .order_by(count_column.desc())
+        .limit(limit)
+    )
+    return [{"player": label, "count": c} for label, c in (await session.execute(q)).all()]
+
+
+async def api_top_species(session, count_column, limit: int, *filters):
+    q = (
+        select(SpeciesStats.species_id, count_column)
+        .where(count_column > 0, *filters)
+        .order_by(count_column.desc())
+        .limit(limit)
+    )
+    return [{"species": sid, "count": c} for sid, c in (await session.execute(q)).all()]
+
+
 # ---------- API ROUTES JSON ----------
 
 @app.get("/api/summary")
-def api_get_summary():
-    s = get_session()
-    d = api_summary(s)
-    s.close()
-    return d
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_summary():
+    async with AsyncSessionLocal() as s:
+        return await api_summary(s)
 
 
 @app.get("/api/species/{species_id}")
-def api_species_json(species_id: str):
-    s = get_session()
-    d = api_species_detail(s, species_id)
-    s.close()
-    return d
+@cache(expire=API_CACHE_EXPIRE)
+async def api_species_json(species_id: str):
+    async with AsyncSessionLocal() as s:
+        return await api_species_detail(s, species_id)
 
 
 @app.get("/api/top/captures")
-def api_get_top_captures(limit: int = 10):
-    s = get_session()
-    q = s.query(
-        Capture.player_id,
-        func.count(Capture.id)
-    ).group_by(Capture.player_id).order_by(func.count(Capture.id).desc()).limit(limit)
-    out = [{"player": anonymize_uuid(pid), "count": c} for pid, c in q]
-    s.close()
-    return out
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_top_captures(limit: int = 10):
+    async with AsyncSessionLocal() as s:
+        return await api_top_players(s, PlayerStats.captures, limit)
 
 
 @app.get("/api/top/shiny")
-def api_get_top_shiny(limit: int = 10):
-    s = get_session()
-    q = s.query(
-        Capture.player_id, func.count(Capture.id)
-    ).filter(Capture.is_shiny == True).group_by(Capture.player_id).order_by(func.count(Capture.id).desc()).limit(limit)
-    out = [{"player": anonymize_uuid(pid), "count": c} for pid, c in q]
-    s.close()
-    return out
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_top_shiny(limit: int = 10):
+    async with AsyncSessionLocal() as s:
+        return await api_top_players(s, PlayerStats.shiny, limit)
 
 
 @app.get("/api/top/legendaries")
-def api_get_top_leg(limit: int = 10):
-    s = get_session()
-    q = s.query(
-        Capture.player_id, func.count(Capture.id)
-    ).join(Species).filter(Species.is_legendary == True).group_by(Capture.player_id).order_by(func.count(Capture.id).desc()).limit(limit)
-    out = [{"player": anonymize_uuid(pid), "count": c} for pid, c in q]
-    s.close()
-    return out
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_top_leg(limit: int = 10):
+    async with AsyncSessionLocal() as s:
+        return await api_top_players(s, PlayerStats.legendaries, limit)
 
 
 @app.get("/api/top/mythicals")
-def api_get_top_myth(limit: int = 10):
-    s = get_session()
-    q = s.query(
-        Capture.player_id, func.count(Capture.id)
-    ).join(Species).filter(Species.is_mythical == True).group_by(Capture.player_id).order_by(func.count(Capture.id).desc()).limit(limit)
-    out = [{"player": anonymize_uuid(pid), "count": c} for pid, c in q]
-    s.close()
-    return out
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_top_myth(limit: int = 10):
+    async with AsyncSessionLocal() as s:
+        return await api_top_players(s, PlayerStats.mythicals, limit)
 
 
 @app.get("/api/top/species")
-def api_get_top_species(limit: int = 50):
-    s = get_session()
-    q = s.query(
-        Capture.species_id, func.count(Capture.id)
-    ).join(Species).filter(
-        Species.is_legendary == False,
-        Species.is_mythical == False
-    ).group_by(Capture.species_id).order_by(func.count(Capture.id).desc()).limit(limit)
-    out = [{"species": sid, "count": c} for sid, c in q]
-    s.close()
-    return out
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_top_species(limit: int = 50):
+    async with AsyncSessionLocal() as s:
+        return await api_top_species(
+            s, SpeciesStats.captures, limit,
+            SpeciesStats.is_legendary == False,
+            SpeciesStats.is_mythical == False,
+        )
 
 
 @app.get("/api/top/shiny-species")
-def api_get_shiny_species(limit: int = 10):
-    s = get_session()
-    q = s.query(
-        Capture.species_id, func.count(Capture.id)
-    ).filter(Capture.is_shiny == True).group_by(Capture.species_id).order_by(func.count(Capture.id).desc()).limit(limit)
-    out = [{"species": sid, "count": c} for sid, c in q]
-    s.close()
-    return out
+@cache(expire=API_CACHE_EXPIRE)
+async def api_get_shiny_species(limit: int = 10):
+    async with AsyncSessionLocal() as s:
+        return await api_top_species(s, SpeciesStats.shiny, limit)
+
+
+# ---------- ADMIN ----------
+
+@app.post("/admin/flush-cache")
+async def flush_cache(request: Request):
+    # Only the CLI loader running next to the server may flush
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403)
+    cleared = await FastAPICache.clear()
+    await load_etag()
+    return {"cleared": cleared}
 
 
 # ---------- HTML ROUTES ----------
@@ -422,10 +855,9 @@ def dashboard(request: Request):
 
 
 @app.get("/species/{species_id}", response_class=HTMLResponse)
-def species_page(request: Request, species_id: str):
-    s = get_session()
-    d = api_species_detail(s, species_id)
-    s.close()
+async def species_page(request: Request, species_id: str):
+    async with AsyncSessionLocal() as s:
+        d = await api_species_detail(s, species_id)
 
     return templates.TemplateResponse(
         "species.html",
@@ -440,12 +872,11 @@ def species_page(request: Request, species_id: str):
 
 
 @app.get("/search/species", response_class=HTMLResponse)
-def search_species_html(request: Request, species: str = Query(...)):
+async def search_species_html(request: Request, species: str = Query(...)):
     species_id = normalize_species_id(species)
 
-    s = get_session()
-    d = api_species_detail(s, species_id)
-    s.close()
+    async with AsyncSessionLocal() as s:
+        d = await api_species_detail(s, species_id)
 
     return templates.TemplateResponse(
         "species.html",
@@ -463,9 +894,10 @@ def search_species_html(request: Request, species: str = Query(...)):
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "load":
-        update_database_from_logs(LOG_FOLDER)
+        if update_database_from_logs(LOG_FOLDER, full="--full" in sys.argv[2:]):
+            notify_cache_flush()
     else:
         print("Usage:")
-        print(" python tropimon_service.py load")
+        print(" python tropimon_service.py load [--full]")
         print(" then run:")
         print(" uvicorn tropimon_service:app --host 0.0.0.0 --port 8000")